@@ -1,8 +1,8 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
+import pyarrow as pa
+import pyarrow.compute as pc
 import io
 
 # --- 1. CONFIGURACIÓN ---
@@ -11,76 +11,258 @@ st.title("🧬 Motor de Segmentación de Comunidades con IA")
 st.markdown("**Sistema de Gemelos Digitales & Data Augmentation.**")
 
 # --- 2. CARGA DE DATOS (Modo Seguro Pandas) ---
+@st.cache_data(show_spinner=False, max_entries=4)
+def leer_archivo(raw, nombre):
+    # Cacheado por contenido: los reruns de Streamlit no vuelven a parsear el archivo
+    if nombre.endswith('.csv'):
+        # El lector de Arrow no falla con bytes inválidos: validamos la codificación antes
+        try:
+            raw.decode('utf-8')
+            encoding = 'utf-8'
+        except UnicodeDecodeError:
+            encoding = 'latin1'
+        # Parser multihilo de Arrow (pyarrow ya viene con streamlit); las columnas quedan en
+        # Arrow en vez de convertirse a NumPy/objetos Python y volver a Arrow más adelante
+        try:
+            df = pd.read_csv(io.BytesIO(raw), encoding=encoding, engine='pyarrow', dtype_backend='pyarrow')
+        except ValueError:
+            # Arrow rechaza filas con celdas finales omitidas ('B,3' bajo 3 columnas) y, antes de
+            # pyarrow 16, los encabezados repetidos (ParserError es subclase de ValueError). El
+            # parser C completa con NaN y renombra los repetidos, como antes. También con columnas
+            # Arrow: etiquetar y construir_texto ven el mismo tipo de columnas que en la lectura normal
+            return pd.read_csv(io.BytesIO(raw), encoding=encoding, dtype_backend='pyarrow')
+        # Arrow deja los encabezados repetidos tal cual: se renombran como lo hace el parser C
+        df.columns = renombrar_duplicadas(df.columns)
+        return df
+    return pd.read_excel(io.BytesIO(raw), engine='calamine')
+
+def renombrar_duplicadas(columnas):
+    # Comentario, Comentario -> Comentario, Comentario.1, sin pisar un nombre que ya exista
+    tomadas = set(columnas)
+    vistas, nuevas = set(), []
+    for c in columnas:
+        nombre, k = c, 0
+        while nombre in vistas or (k and nombre in tomadas):
+            k += 1
+            nombre = f'{c}.{k}'
+        vistas.add(nombre)
+        tomadas.add(nombre)
+        nuevas.append(nombre)
+    return nuevas
+
 def cargar_datos_seguro(file):
     try:
-        if file.name.endswith('.csv'):
-            try:
-                return pd.read_csv(file, encoding='utf-8')
-            except:
-                file.seek(0)
-                return pd.read_csv(file, encoding='latin1')
-        else:
-            return pd.read_excel(file, engine='openpyxl')
+        return leer_archivo(file.getvalue(), file.name)
     except Exception as e:
         st.error(f"Error de lectura: {e}")
         return None
 
+def _hash_df(df):
+    # Clave de caché con el hash vectorizado de pandas sobre TODAS las filas: desde 50k filas el
+    # hash por defecto de Streamlit solo mira una muestra de 10k y puede no ver un cambio fuera de
+    # ella. Como ese hash, incluye los tipos de columna además de nombres y valores
+    return (tuple(map(str, df.columns)), tuple(map(str, df.dtypes)),
+            pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+
+HASH_DF = {pd.DataFrame: _hash_df}
+
 # --- 3. CEREBRO IA (Lógica mantenida) ---
+# Reglas de texto en orden de prioridad: gana la primera que calce
+PALABRAS_CLAVE = [
+    ('Crítico Infraestructura', r'infra|luz|baño|cancha|agua|sucio'),
+    ('Competitivo', r'compet|ganar|torneo|copa|medal'),
+    ('Social', r'social|amigo|grupo|asado|fies'),
+    ('Formativo', r'clase|profe|aprender|taller'),
+]
+ARQUETIPOS = [a for a, _ in PALABRAS_CLAVE] + ['Promotor', 'Detractor', 'Neutro']
+
+def columna_texto_arrow(serie):
+    # Columnas ya en Arrow (CSV) se castean sin pasar por objetos Python; el resto (Excel
+    # con tipos mezclados) se stringifica como siempre
+    if isinstance(serie.dtype, pd.ArrowDtype):
+        return pc.fill_null(pc.cast(pa.array(serie), pa.string()), '')
+    return pa.array(serie.fillna('').astype(str), type=pa.string())
+
+@st.cache_data(show_spinner=False, max_entries=4, hash_funcs=HASH_DF)
+def construir_texto(df_txt):
+    # Concatenación y minúsculas con kernels UTF-8 de Arrow; la columna queda en Arrow para que
+    # los str.contains también corran sobre sus buffers. Caché propio, con solo las columnas de
+    # texto como clave: cambiar la nota, el segmento o el universo no obliga a rehacer el texto
+    textos = [columna_texto_arrow(df_txt[c]) for c in df_txt.columns]
+    unido = pc.utf8_lower(pc.binary_join_element_wise(*textos, ' '))
+    return pd.Series(unido, index=df_txt.index, dtype=pd.ArrowDtype(pa.string()))
+
 class CommunityAI:
-    def procesar(self, df, col_seg, col_nps, cols_txt, total_universo):
-        # A. Etiquetado
-        df['Texto_Full'] = df[cols_txt].fillna('').astype(str).agg(' '.join, axis=1).str.lower()
+    @staticmethod
+    def etiquetar(df, col_nps, cols_txt):
+        txt = construir_texto(df[cols_txt])
         
-        def clasificar(row):
-            txt = row['Texto_Full']
-            try:
-                score = float(row[col_nps])
-            except:
-                score = 0
-            
-            if any(x in txt for x in ['infra', 'luz', 'baño', 'cancha', 'agua', 'sucio']): return 'Crítico Infraestructura'
-            if any(x in txt for x in ['compet', 'ganar', 'torneo', 'copa', 'medal']): return 'Competitivo'
-            if any(x in txt for x in ['social', 'amigo', 'grupo', 'asado', 'fies']): return 'Social'
-            if any(x in txt for x in ['clase', 'profe', 'aprender', 'taller']): return 'Formativo'
-            if score >= 6: return 'Promotor'
-            if score <= 4: return 'Detractor'
-            return 'Neutro'
-
-        df['Arquetipo'] = df.apply(clasificar, axis=1)
+        # Nota no numérica cuenta como 0; una celda vacía queda sin nota (Neutro)
+        score = pd.to_numeric(df[col_nps], errors='coerce').to_numpy(dtype=float, na_value=np.nan, copy=True)
+        score[np.isnan(score) & df[col_nps].notna().to_numpy()] = 0
+
+        # Reglas de texto vectorizadas (regex RE2 de Arrow) en orden de prioridad: cada regla
+        # solo escanea las filas que aún no calzaron, y se asignan códigos enteros (no strings)
+        n_reglas = len(PALABRAS_CLAVE)
+        codigos = np.full(len(df), n_reglas + 2, dtype=np.int8)  # Neutro
+        pendientes = np.arange(len(df))
+        for k, (_, patron) in enumerate(PALABRAS_CLAVE):
+            calza = txt.iloc[pendientes].str.contains(patron, regex=True, na=False).to_numpy()
+            codigos[pendientes[calza]] = k
+            pendientes = pendientes[~calza]
+
+        # Sin palabras clave decide la nota
+        codigos[pendientes[score[pendientes] >= 6]] = n_reglas      # Promotor
+        codigos[pendientes[score[pendientes] <= 4]] = n_reglas + 1  # Detractor
+        # Categorías fijas (los 7 arquetipos conocidos): mismo dtype en cada corrida
+        return pd.Categorical.from_codes(codigos, ARQUETIPOS)
+
+    def matriz_proyectada(self, df, col_seg, col_nps, cols_txt):
+        # Los sintéticos replican la distribución conjunta real Segmento x Arquetipo, así que el
+        # mapa esperado del universo proyectado es P(Arquetipo | Segmento) de la encuesta:
+        # se calcula sin materializar ninguna fila sintética
+        arquetipos = arquetipos_encuesta(df[list(dict.fromkeys([col_nps, *cols_txt]))], col_nps, cols_txt)
+        # Filas sin segmento fuera antes de agrupar: si no, unstack desordena los arquetipos y el
+        # eje X del mapa deja de seguir el orden de ARQUETIPOS
+        conteo = pd.DataFrame({col_seg: df[col_seg].astype('category'), 'Arquetipo': arquetipos}) \
+            .dropna(subset=[col_seg]) \
+            .groupby([col_seg, 'Arquetipo'], observed=True).size().unstack(fill_value=0)
+        return conteo.div(conteo.sum(axis=1), axis=0)
+
+    def procesar(self, df, col_seg, col_nps, cols_txt, total_universo, semilla=None):
+        rng = np.random.default_rng(semilla)
+        faltantes = total_universo - len(df)
+        # Con sintéticos solo importan segmento, nota y texto: el resto de columnas no se copia
+        if faltantes > 0:
+            df = df[list(dict.fromkeys([col_seg, col_nps, *cols_txt]))]
+        df = df.copy()
+
+        # A. Etiquetado (cacheado: el mapa ya etiquetó estas mismas columnas)
+        df['Arquetipo'] = arquetipos_encuesta(df[list(dict.fromkeys([col_nps, *cols_txt]))], col_nps, cols_txt)
+        codigos = df['Arquetipo'].cat.codes.to_numpy()
+        # Segmento como categoría: la tabla de conteos (groupby) y Categorical.from_codes usan sus
+        # códigos enteros, no strings
+        df[col_seg] = df[col_seg].astype('category')
         
         # B. Generación de Sintéticos
-        real_count = len(df)
-        faltantes = total_universo - real_count
-        
         if faltantes <= 0:
+            df['Texto_Full'] = construir_texto(df[cols_txt])
             df['Origen'] = 'Real'
             return df
             
-        # Cálculo de probabilidades
-        dist_seg = df[col_seg].value_counts(normalize=True)
-        # Probabilidad de Arquetipo DADO el Segmento
-        matrix_prob = pd.crosstab(df[col_seg], df['Arquetipo'], normalize='index')
-        global_prob = df['Arquetipo'].value_counts(normalize=True)
+        # Cálculo de probabilidades: una sola tabla de conteos Segmento x Arquetipo
+        conteo = df.groupby([col_seg, 'Arquetipo'], observed=True).size().unstack(fill_value=0)
+        frecuencias = conteo.to_numpy()
         
-        # Generamos
-        nuevos_seg = np.random.choice(dist_seg.index, size=faltantes, p=dist_seg.values)
-        sinteticos = []
+        # Generamos: un solo sorteo multinomial sobre la distribución conjunta Segmento x Arquetipo
+        # (equivale a sortear el segmento y luego el arquetipo dado el segmento) y se expande con np.repeat
+        por_celda = rng.multinomial(faltantes, frecuencias.ravel() / frecuencias.sum())
+        seg_celda, arq_celda = np.meshgrid(conteo.index.codes, conteo.columns.codes, indexing='ij')
+        # Se barajan los códigos para que los sintéticos salgan en orden aleatorio, no en bloques
+        orden = rng.permutation(faltantes)
         
-        for seg in nuevos_seg:
-            if seg in matrix_prob.index:
-                probs = matrix_prob.loc[seg]
-                arq = np.random.choice(probs.index, p=probs.values)
-            else:
-                arq = np.random.choice(global_prob.index, p=global_prob.values)
-            sinteticos.append({col_seg: seg, 'Arquetipo': arq, 'Origen': 'Sintético (IA)'})
-            
-        df_sintetico = pd.DataFrame(sinteticos)
-        df_real = df[[col_seg, 'Arquetipo']].copy()
-        df_real['Origen'] = 'Real (Encuesta)'
+        # Resultado en un solo DataFrame: reales + sintéticos como códigos enteros, sin pd.concat
+        n_real = len(df)
+        seg_codigos = np.concatenate([df[col_seg].cat.codes.to_numpy(), np.repeat(seg_celda.ravel(), por_celda)[orden]])
+        arq_codigos = np.concatenate([codigos, np.repeat(arq_celda.ravel(), por_celda)[orden]])
+        origen_codigos = np.repeat(np.array([0, 1], dtype=np.int8), [n_real, faltantes])
         
-        return pd.concat([df_real, df_sintetico], ignore_index=True)
+        return pd.DataFrame({
+            col_seg: pd.Categorical.from_codes(seg_codigos, dtype=df[col_seg].dtype),
+            'Arquetipo': pd.Categorical.from_codes(arq_codigos, dtype=df['Arquetipo'].dtype),
+            'Origen': pd.Categorical.from_codes(origen_codigos, ['Real (Encuesta)', 'Sintético (IA)'])
+        }, copy=False)
+
+@st.cache_data(show_spinner=False, max_entries=4, hash_funcs=HASH_DF)
+def arquetipos_encuesta(df_lbl, col_nps, cols_txt):
+    # Clave de caché con solo nota y texto: cambiar el segmento o el universo no re-etiqueta
+    return CommunityAI.etiquetar(df_lbl, col_nps, cols_txt)
+
+@st.cache_resource(show_spinner=False, max_entries=4, hash_funcs=HASH_DF)
+def proyectar_universo(df, col_seg, col_nps, cols_txt, total_universo, semilla=42):
+    # Semilla fija: mismas entradas -> mismo universo, esté o no en caché.
+    # cache_resource entrega el mismo objeto sin copiarlo: el resultado NO se debe mutar
+    return CommunityAI().procesar(df, col_seg, col_nps, cols_txt, total_universo, semilla)
+
+@st.cache_data(show_spinner=False, max_entries=4, hash_funcs=HASH_DF)
+def mapa_proyectado(df, col_seg, col_nps, cols_txt):
+    return CommunityAI().matriz_proyectada(df, col_seg, col_nps, cols_txt)
+
+def exportar_parquet(df_final):
+    # Parquet columnar y comprimido; las etiquetas categóricas van como diccionario
+    buf = io.BytesIO()
+    try:
+        df_final.to_parquet(buf, engine='pyarrow', compression='zstd', index=False)
+    except (TypeError, ValueError):
+        # Columnas con tipos mezclados (típico de Excel) no entran en Arrow: se exportan como texto
+        buf = io.BytesIO()
+        mixtas = df_final.select_dtypes(include='object').columns
+        df_final.astype({c: 'string' for c in mixtas}).to_parquet(buf, engine='pyarrow', compression='zstd', index=False)
+    return buf.getvalue()
+
+def exportar_csv(df_final):
+    # Se escribe directo al buffer de bytes: sin copia intermedia como str
+    buf = io.BytesIO()
+    df_final.to_csv(buf, index=False, encoding='utf-8')
+    return buf.getvalue()
 
 # --- 4. INTERFAZ ---
+# Fragmento: cambiar columnas o ejecutar solo re-corre este panel, no la carga de arriba
+@st.fragment
+def panel_analisis(df, total_universo):
+    c1, c2, c3 = st.columns(3)
+    col_seg = c1.selectbox("Columna Segmento (Rama)", df.columns)
+    col_nps = c2.selectbox("Columna Nota/NPS", df.columns)
+    cols_txt = c3.multiselect("Columnas Texto", df.columns)
+    
+    if st.button("🚀 EJECUTAR ANÁLISIS", type="primary"):
+        if cols_txt:
+            with st.spinner("Analizando encuesta..."):
+                matriz = mapa_proyectado(df, col_seg, col_nps, cols_txt)
+            
+            st.balloons()
+            
+            # Métricas
+            m1, m2 = st.columns(2)
+            m1.metric("Muestra Real", len(df))
+            m2.metric("Universo Proyectado", max(total_universo, len(df)))
+            
+            # Gráfico: mapa esperado del universo, sin generar las filas sintéticas
+            st.subheader("Mapa Estratégico")
+            # Altair: se envía una especificación JSON liviana y el
+            # navegador dibuja el mapa; sin render de PNG en el servidor en cada rerun
+            import altair as alt
+            datos = matriz.rename_axis(index='Segmento', columns='Arquetipo').stack().rename('Porcentaje').reset_index()
+            datos[['Segmento', 'Arquetipo']] = datos[['Segmento', 'Arquetipo']].astype(str)
+            
+            base = alt.Chart(datos).encode(
+                x=alt.X('Arquetipo:N', sort=list(matriz.columns.astype(str)), title='Arquetipo'),
+                y=alt.Y('Segmento:N', sort=list(matriz.index.astype(str)), title=str(col_seg)),
+            )
+            celdas = base.mark_rect().encode(
+                color=alt.Color('Porcentaje:Q', scale=alt.Scale(scheme='blues', domainMin=0), legend=alt.Legend(format='.0%')),
+                tooltip=['Segmento', 'Arquetipo', alt.Tooltip('Porcentaje:Q', format='.1%')],
+            )
+            # Texto solo en celdas relevantes (>5%)
+            etiquetas = base.mark_text(fontSize=11).encode(
+                text=alt.Text('Porcentaje:Q', format='.1%'),
+                color=alt.condition(alt.datum.Porcentaje > datos['Porcentaje'].max() / 2, alt.value('white'), alt.value('black')),
+            ).transform_filter(alt.datum.Porcentaje > 0.05)
+            st.altair_chart(celdas + etiquetas)
+            
+            # Descarga: el universo con sintéticos se genera recién al hacer clic (callable), en
+            # Parquet (columnar y comprimido) o CSV estándar para máxima compatibilidad
+            def universo():
+                return proyectar_universo(df, col_seg, col_nps, cols_txt, total_universo)
+            
+            d1, d2 = st.columns(2)
+            d1.download_button("📥 Descargar Resultado (Parquet)", lambda: exportar_parquet(universo()),
+                               "universo_ia.parquet", "application/octet-stream", on_click='ignore')
+            d2.download_button("📥 Descargar Resultado (CSV)", lambda: exportar_csv(universo()),
+                               "universo_ia.csv", "text/csv", on_click='ignore')
+        else:
+            st.error("Selecciona columnas de texto.")
+
 uploaded_file = st.file_uploader("📂 Sube tu Excel o CSV aquí", type=['xlsx','csv'])
 total_universo = st.number_input("Universo Total a Proyectar", value=5000, step=100)
 
@@ -93,33 +275,4 @@ if uploaded_file:
             st.dataframe(df.head())
             
         st.divider()
-        c1, c2, c3 = st.columns(3)
-        col_seg = c1.selectbox("Columna Segmento (Rama)", df.columns)
-        col_nps = c2.selectbox("Columna Nota/NPS", df.columns)
-        cols_txt = c3.multiselect("Columnas Texto", df.columns)
-        
-        if st.button("🚀 EJECUTAR ANÁLISIS", type="primary"):
-            if cols_txt:
-                ai = CommunityAI()
-                with st.spinner("Generando universo..."):
-                    df_final = ai.procesar(df, col_seg, col_nps, cols_txt, total_universo)
-                
-                st.balloons()
-                
-                # Métricas
-                m1, m2 = st.columns(2)
-                m1.metric("Muestra Real", len(df))
-                m2.metric("Universo Proyectado", len(df_final))
-                
-                # Gráfico
-                st.subheader("Mapa Estratégico")
-                matriz = pd.crosstab(df_final[col_seg], df_final['Arquetipo'], normalize='index')
-                fig, ax = plt.subplots(figsize=(10,5))
-                sns.heatmap(matriz, annot=True, fmt=".1%", cmap="Blues", ax=ax)
-                st.pyplot(fig)
-                
-                # Descarga (Método estándar CSV para máxima compatibilidad)
-                csv = df_final.to_csv(index=False).encode('utf-8')
-                st.download_button("📥 Descargar Resultado (CSV)", csv, "universo_ia.csv", "text/csv")
-            else:
-                st.error("Selecciona columnas de texto.")
+        panel_analisis(df, total_universo)